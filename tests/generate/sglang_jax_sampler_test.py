@@ -12,25 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
 import os
-import re
-import tempfile
 
 from absl.testing import absltest
 from flax import nnx
 import huggingface_hub
 import jax
 import jax.numpy as jnp
-import numpy as np
 import qwix
 import transformers
 from tunix.generate import sampler as vanilla_sampler
 from tunix.generate import sglang_jax_sampler, mappings
+from tunix.generate import utils as sampler_utils
 from tunix.models.llama3 import model as llama_lib
 from tunix.models.llama3 import params as llama_params
 from tunix.sft import utils as base_utils
 from tunix.tests import test_common as tc
 
+# Persist compiled executables so that repeated runs skip XLA compilation of
+# the prefill and decode graphs.
+jax.config.update(
+    "jax_compilation_cache_dir",
+    os.environ.get("JAX_COMPILATION_CACHE_DIR", "/tmp/tunix_jit_cache"),
+)
+jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+jax.config.update("jax_persistent_cache_min_compile_time_secs", 1)
+
+# Prompts shared by all samplers, and the keywords each response must contain.
+_PROMPTS = (
+    "Hello, my name is Tom.",
+    "The capital of France is",
+    "why is sky blue?",
+)
+_EXPECTED_OUTPUT_PATTERN = (
+    (_PROMPTS[0], ("Tom", "help")),
+    (_PROMPTS[1], ("Paris",)),
+    (_PROMPTS[2], ("Rayleigh", "scattering")),
+)
+
 
 class SglangJaxSamplerTest(absltest.TestCase):
 
@@ -42,11 +62,67 @@ class SglangJaxSamplerTest(absltest.TestCase):
     cls.mesh = jax.make_mesh(mesh_shape, axis_names, devices=jax.devices())
 
     cls.repo_id = "meta-llama/Llama-3.1-8B-Instruct"
-    temp_dir = tempfile.gettempdir()
-    cls.model_path = os.path.join(temp_dir, "models", cls.repo_id)
+    # Keep the checkpoint under the persistent HF cache so that repeated runs
+    # skip the download.
+    hf_home = os.path.expanduser(
+        os.environ.get("HF_HOME", "~/.cache/huggingface")
+    )
+    cls.model_path = os.path.join(hf_home, "models", cls.repo_id)
     tc.download_from_huggingface(repo_id=cls.repo_id, model_path=cls.model_path)
+    cls._tokenizer = transformers.AutoTokenizer.from_pretrained(cls.model_path)
+    cls._tunix_model = cls.load_llama3_model(cls.repo_id)
+    base_utils.show_hbm_usage("After loading tunix model")
+
+    cls.inputs = tc.batch_templatize(_PROMPTS, tokenizer=cls._tokenizer)
+
+    # Leave a safety margin for the expected keywords; shorter responses stop
+    # early on EOS.
+    cls.max_generation_steps = 64
+    # The KV cache is sized from the padded prompts plus the generation budget
+    # rather than a fixed upper bound. The sampler prepends a BOS token to every
+    # prompt.
+    cls.max_prompt_length = sampler_utils.next_power_of_2(
+        max(len(cls._tokenizer.encode(x)) + 1 for x in cls.inputs)
+    )
+
+    # Run the vanilla sampler first and release it before the sglang-jax engine
+    # is created, so that the two samplers never hold HBM at the same time.
+    cls._vanilla_output = cls.run_vanilla_sampler()
+    gc.collect()
+    jax.clear_caches()
+    base_utils.show_hbm_usage("After releasing vanilla sampler")
+
+    cls._sglang_jax_sampler = cls.build_sglang_jax_sampler()
+
+    # Only the sglang-jax model is used from here on. Keep the tunix lm_head for
+    # the weight mapping check and free the rest of the tunix copy. The sync
+    # device_puts every leaf onto the sglang-jax shardings, which hands back the
+    # source array itself when the sharding already matches, so arrays held by
+    # the sglang-jax model are kept.
+    cls._tunix_lm_head = nnx.state(cls._tunix_model)["lm_head"]["w"].value
+    sglangjax_state = nnx.state(cls._sglang_jax_sampler._model_runner.model)
+    cls.free_tunix_model(keep=(cls._tunix_lm_head, sglangjax_state))
+    base_utils.show_hbm_usage("After freeing tunix model")
+
+  @classmethod
+  def tearDownClass(cls) -> None:
+    cls._sglang_jax_sampler = None
+    cls._tunix_lm_head = None
+    gc.collect()
+    jax.clear_caches()
+    super().tearDownClass()
+
+  @classmethod
+  def free_tunix_model(cls, keep=()):
+    """Deletes the tunix model's device arrays, except those in `keep`."""
+    keep_ids = {id(x) for x in jax.tree_util.tree_leaves(keep)}
+    for x in jax.tree_util.tree_leaves(nnx.state(cls._tunix_model)):
+      if isinstance(x, jax.Array) and id(x) not in keep_ids:
+        x.delete()
+    cls._tunix_model = None
 
-  def load_llama3_model(self, model_version: str):
+  @classmethod
+  def load_llama3_model(cls, model_version: str):
     model_config = {
         "meta-llama/Llama-3.2-1B-Instruct": llama_lib.ModelConfig.llama3_2_1b,
         "meta-llama/Llama-3.1-8B-Instruct": llama_lib.ModelConfig.llama3_1_8b,
@@ -57,45 +133,28 @@ class SglangJaxSamplerTest(absltest.TestCase):
     model_config = model_config[model_version]()
 
     llama3 = llama_params.create_model_from_safe_tensors(
-        self.model_path, model_config, self.mesh
+        cls.model_path, model_config, cls.mesh
     )
     # nnx.display(llama3)
     return llama3
 
-  def test_sglang_jax_sampler(self):
-    tunix_model = self.load_llama3_model(self.repo_id)
-
-    args = {}
-    args["model_path"] = self.model_path
-
-    base_utils.show_hbm_usage("After loading tunix model")
-
-    # Sampler setup
-    model_tokenizer = transformers.AutoTokenizer.from_pretrained(
-        self.model_path
+  @classmethod
+  def run_vanilla_sampler(cls):
+    """Generates from the tunix model; the sampler is dropped on return."""
+    cache_size = sampler_utils.next_power_of_2(
+        cls.max_prompt_length + cls.max_generation_steps
     )
-
-    # Generate texts from the prompts. The output is a list of RequestOutput
-    # objects that contain the prompt, generated text, and other information.
-    prompts = [
-        "Hello, my name is Tom.",
-        "The capital of France is",
-        "why is sky blue?",
-    ]
-
-    inputs = tc.batch_templatize(prompts, tokenizer=model_tokenizer)
-
     vn_sampler = vanilla_sampler.Sampler(
-        transformer=tunix_model,
-        tokenizer=model_tokenizer,
+        transformer=cls._tunix_model,
+        tokenizer=cls._tokenizer,
         cache_config=vanilla_sampler.CacheConfig(
-            cache_size=512, num_layers=32, num_kv_heads=8, head_dim=128
+            cache_size=cache_size, num_layers=32, num_kv_heads=8, head_dim=128
         ),
     )
-    vanilla_output = vn_sampler(
-        input_strings=inputs,
-        max_generation_steps=128,  # Changed from 768 to 128 for sglang-jax
-        max_prompt_length=None,  # Use default max prompt length
+    return vn_sampler(
+        input_strings=cls.inputs,
+        max_generation_steps=cls.max_generation_steps,
+        max_prompt_length=cls.max_prompt_length,
         temperature=0.0,
         # top_p=0.9,
         top_k=1,
@@ -104,34 +163,47 @@ class SglangJaxSamplerTest(absltest.TestCase):
         pad_output=True,  # Use padding for output
     )
 
+  @classmethod
+  def build_sglang_jax_sampler(cls):
+    """Builds the sglang-jax sampler and syncs the tunix weights into it."""
     mapping_config = mappings.MappingConfig.build(
-        model=tunix_model, backend="sglang_jax"
+        model=cls._tunix_model, backend="sglang_jax"
     )
-
     sglang_jax_config = sglang_jax_sampler.SglangJaxConfig(
-        model_version=self.model_path,
+        model_version=cls.model_path,
         context_length=512,
-        mesh=self.mesh,
-        mem_fraction_static=0.2,
+        mesh=cls.mesh,
+        # Fraction of the HBM still free after the dummy weights load that goes
+        # to the KV pool. The tunix copy is resident at that point and the sync
+        # needs room for the resharded weights, so keep it small; three short
+        # prompts need only a few hundred KV slots.
+        mem_fraction_static=float(os.environ.get("SGLANG_MEM_FRAC", "0.2")),
         init_with_random_weights=True,
         disable_radix_cache=True,
         enable_deterministic_sampling=False,
         mapping_config=mapping_config,
+        page_size=16,
     )
-
     vl_sampler = sglang_jax_sampler.SglangJaxSampler(
-        tokenizer=model_tokenizer,
+        tokenizer=cls._tokenizer,
         config=sglang_jax_config,
     )
-    state = nnx.state(tunix_model)
+    state = nnx.state(cls._tunix_model)
     vl_sampler.load_checkpoint(state)
 
     base_utils.show_hbm_usage("After loading sglang jax sampler")
+    return vl_sampler
 
-    sglang_jax_output = vl_sampler(
-        input_strings=inputs,
-        max_generation_steps=128,
-        max_prompt_length=None,  # Use default max prompt length
+  def test_vanilla_sampler(self):
+    print("-" * 50)
+    print(f"Vanilla Generated text: {self._vanilla_output.text}")
+    tc.validate_llm_outputs(_EXPECTED_OUTPUT_PATTERN, self._vanilla_output.text)
+
+  def test_sglang_jax_sampler(self):
+    sglang_jax_output = self._sglang_jax_sampler(
+        input_strings=self.inputs,
+        max_generation_steps=self.max_generation_steps,
+        max_prompt_length=self.max_prompt_length,
         temperature=0.0,
         # top_p=0.9,
         top_k=1,
@@ -140,31 +212,21 @@ class SglangJaxSamplerTest(absltest.TestCase):
         pad_output=True,  # Use padding for output
     )
 
-    expected_output_pattern = [
-        (prompts[0], ["Tom", "help"]),
-        (prompts[1], ["Paris"]),
-        (prompts[2], ["Rayleigh", "scattering"]),
-    ]
-
-    print("-" * 50)
-    print(f"Vanilla Generated text: {vanilla_output.text}")
-
-    tc.validate_llm_outputs(expected_output_pattern, vanilla_output.text)
-
     print("-" * 50)
     print(f"sglang jax Generated text: {sglang_jax_output.text}")
-    tc.validate_llm_outputs(expected_output_pattern, sglang_jax_output.text)
-
-    _, tunix_state = nnx.split(tunix_model)
-    _, sglangjax_state = nnx.split(vl_sampler._model_runner.model)
-    self.assertTrue(
-        np.allclose(
-            tunix_state["lm_head"]["w"].value,
-            jnp.transpose(
-                sglangjax_state["lm_head"]["embedding"].value, (1, 0)
-            ),
-        )
+    tc.validate_llm_outputs(_EXPECTED_OUTPUT_PATTERN, sglang_jax_output.text)
+
+  def test_weight_mapping_consistency(self):
+    _, sglangjax_state = nnx.split(self._sglang_jax_sampler._model_runner.model)
+    # Compare on device in the model's native dtype (bf16) so that neither
+    # operand is promoted to fp32 and only the boolean result reaches the host.
+    lm_head_matches = jax.jit(
+        lambda a, b: jnp.allclose(a, b.T.astype(a.dtype), atol=1e-3, rtol=1e-3)
+    )(
+        self._tunix_lm_head,
+        sglangjax_state["lm_head"]["embedding"].value,
     )
+    self.assertTrue(bool(lm_head_matches))
 
 
 if __name__ == "__main__":
@@ -42,6 +42,7 @@ class SglangJaxConfig:
   disable_radix_cache: bool
   enable_deterministic_sampling: bool
   mapping_config: mappings.MappingConfig
+  page_size: int = 64
 
 
 class SglangJaxSampler(base_sampler.BaseSampler):  # pylint: disable=invalid-name
@@ -109,7 +110,7 @@ class SglangJaxSampler(base_sampler.BaseSampler):  # pylint: disable=invalid-nam
     args["precompile_bs_paddings"] = [1, 64]
     args["precompile_token_paddings"] = [8192]
     args["disable_jax_precompile"] = True
-    args["page_size"] = 64
+    args["page_size"] = config.page_size
     args["context_length"] = config.context_length
     args["tp_size"] = self._find_tp_size(config.mesh)
     args["mem_fraction_static"] = config.mem_fraction_static
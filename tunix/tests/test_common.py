@@ -248,34 +248,56 @@ class MockTransformerWithScoreHead(nnx.Module):
     return score
 
 
-def download_from_huggingface(repo_id: str, model_path: str):
-  """Download checkpoint files from huggingface."""
-  print('Make sure you logged in to the huggingface cli.')
-  all_files = huggingface_hub.list_repo_files(repo_id)
-  filtered_files = [f for f in all_files if not f.startswith('original/')]
+# Written to the download directory once `snapshot_download` returns.
+_DOWNLOAD_COMPLETE_MARKER = '.tunix_download_complete'
 
-  for filename in filtered_files:
-    huggingface_hub.hf_hub_download(
-        repo_id=repo_id, filename=filename, local_dir=model_path
-    )
-  print(f'Downloaded {filtered_files} to: {model_path}')
+
+def download_from_huggingface(
+    repo_id: str, model_path: str, max_workers: int = 16
+):
+  """Download checkpoint files from huggingface.
+
+  Files under `original/` are skipped. A marker file is written once the
+  download finishes; if `model_path` already holds it, no network request is
+  made and the local copy is reused. Otherwise the download resumes and only
+  missing files are fetched.
+
+  Args:
+    repo_id: The huggingface repo to download.
+    model_path: Local directory to download the files to.
+    max_workers: Number of files downloaded concurrently.
+
+  Returns:
+    The local directory holding the checkpoint, i.e. `model_path`.
+  """
+  marker_path = os.path.join(model_path, _DOWNLOAD_COMPLETE_MARKER)
+  if os.path.isfile(marker_path):
+    print(f'Found existing checkpoint at: {model_path}, skip downloading.')
+    return model_path
+  print('Make sure you logged in to the huggingface cli.')
+  huggingface_hub.snapshot_download(
+      repo_id=repo_id,
+      ignore_patterns=['original/*'],
+      local_dir=model_path,
+      max_workers=max_workers,
+  )
+  with open(marker_path, 'w') as f:
+    f.write(repo_id)
+  print(f'Downloaded {repo_id} to: {model_path}')
+  return model_path
 
 
 def batch_templatize(prompts: List[str], tokenizer: Any):
   """Use tokenizer to batch templatize the prompts."""
   assert hasattr(tokenizer, 'apply_chat_template')
-  out = []
-  for p in prompts:
-    out.append(
-        tokenizer.apply_chat_template(
-            [
-                {'role': 'user', 'content': p},
-            ],
-            tokenize=False,
-            add_generation_prompt=True,
-        )
-    )
-  return out
+  prompts = list(prompts)
+  if not prompts:
+    return []
+  return tokenizer.apply_chat_template(
+      [[{'role': 'user', 'content': p}] for p in prompts],
+      tokenize=False,
+      add_generation_prompt=True,
+  )
 
 
 def validate_llm_outputs(